@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+from collections import deque
+from datetime import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from aiohttp import web
+
+# Локальная заглушка Bot API и замеры bot_telegram без обращения к настоящему Telegram.
+# Пример: python bench_bot.py --subscribers 1000 10000 --latency 0.005 --fail-every 500
+
+BENCH_TOKEN = '123456:bench-token'
+BENCH_USER_BASE = 10_000_000
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, fail_every=0, retry_after=1):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.runner = None
+        self.updates = deque()
+        self.new_updates = asyncio.Event()
+        self.calls = {}
+        self.rate_limited = 0
+        self.message_id = 0
+        self.waiter = None
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def reset(self):
+        self.calls = {}
+        self.rate_limited = 0
+
+    def push_updates(self, updates):
+        self.updates.extend(updates)
+        self.new_updates.set()
+
+    async def wait_for_calls(self, methods, count, timeout=600):
+        loop = asyncio.get_running_loop()
+        self.waiter = (methods, count, loop.create_future())
+        if self.replies(methods) >= count:
+            self.waiter[2].set_result(None)
+        await asyncio.wait_for(self.waiter[2], timeout)
+
+    def replies(self, methods):
+        return sum(self.calls.get(method, 0) for method in methods)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == 'getUpdates':
+            return self.ok(await self.get_updates(params))
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'sendMessage' and self.fail_every:
+            if (self.calls.get(method, 0) + self.rate_limited + 1) % self.fail_every == 0:
+                self.rate_limited += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                })
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.waiter and not self.waiter[2].done() and self.replies(self.waiter[0]) >= self.waiter[1]:
+            self.waiter[2].set_result(None)
+
+        if method == 'getMe':
+            return self.ok({'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        if method in ('sendMessage', 'editMessageText'):
+            self.message_id += 1
+            return self.ok({
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            })
+        return self.ok(True)
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get('timeout') or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    def ok(self, result):
+        return web.json_response({'ok': True, 'result': result})
+
+def make_message_update(update_id, user_id, text):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+        },
+    }
+
+def reset_state(bt):
+    bt.subscriptions.clear()
+    bt.confirmations.clear()
+    bt.user_reminder_times.clear()
+    bt.delivered_slots.clear()
+    bt.store.pending.clear()
+
+async def bench_updates(bt, api, count, users):
+    reset_state(bt)
+    api.reset()
+    # 429 в обработчиках не ретраится, поэтому здесь ошибки не подмешиваем
+    fail_every, api.fail_every = api.fail_every, 0
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = BENCH_USER_BASE + update_id % users
+        text = '/start' if update_id % 2 else bt.NAMES[update_id % len(bt.NAMES)]
+        updates.append(make_message_update(update_id, user_id, text))
+
+    polling = asyncio.create_task(
+        bt.dp.start_polling(bt.bot, handle_signals=False, close_bot_session=False, polling_timeout=1)
+    )
+    started = time.perf_counter()
+    api.push_updates(updates)
+    await api.wait_for_calls(('sendMessage',), count)
+    elapsed = time.perf_counter() - started
+    await bt.dp.stop_polling()
+    await polling
+    api.fail_every = fail_every
+    return {
+        'updates': count,
+        'users': users,
+        'seconds': round(elapsed, 4),
+        'updates_per_second': round(count / elapsed, 1),
+    }
+
+async def bench_fanout(bt, api, subscribers, args):
+    reset_state(bt)
+    api.reset()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    duty_day = bt.next_duty_day(today)
+    name = bt.duty_name_on(duty_day)
+    for offset in range(subscribers):
+        bt.subscribe_user(BENCH_USER_BASE + offset, name)
+    bt.store.pending.clear()
+
+    bt.reminder.sender = bt.FanOutSender(
+        concurrency=args.concurrency, rate=args.rate, chat_interval=0, batch_size=args.batch_size
+    )
+    started = time.perf_counter()
+    await bt.reminder.send_reminders(duty_day.replace(hour=12))
+    elapsed = time.perf_counter() - started
+    sent = api.calls.get('sendMessage', 0)
+    return {
+        'subscribers': subscribers,
+        'sent': sent,
+        'rate_limited': api.rate_limited,
+        'seconds': round(elapsed, 4),
+        'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+    }
+
+def bench_memory(bt, users):
+    reset_state(bt)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for offset in range(users):
+        # Как в настоящем апдейте: у каждого сообщения своя строка с именем
+        name = bt.NAMES[offset % len(bt.NAMES)].encode().decode()
+        bt.subscribe_user(BENCH_USER_BASE + offset, name)
+        bt.confirmations.confirm(BENCH_USER_BASE + offset, today)
+    bt.store.pending.clear()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    reset_state(bt)
+    return {
+        'users': users,
+        'bytes_total': allocated,
+        'bytes_per_user': round(allocated / users, 1),
+    }
+
+async def bench_startup(bt, users, env):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.db')
+        backend = bt.SqliteBackend(path)
+        backend.open()
+        names = bt.NAMES
+        backend.apply({
+            ('subscriptions', BENCH_USER_BASE + offset): names[offset % len(names)]
+            for offset in range(users)
+        })
+        backend.close()
+
+        reset_state(bt)
+        store = bt.StateStore(bt.SqliteBackend(path))
+        started = time.perf_counter()
+        await store.load()
+        load_seconds = time.perf_counter() - started
+        store.backend.close()
+        reset_state(bt)
+
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', 'import bot_telegram'],
+        env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    import_seconds = time.perf_counter() - started
+    return {
+        'users': users,
+        'state_load_seconds': round(load_seconds, 4),
+        'import_seconds': round(import_seconds, 4),
+    }
+
+async def run(args):
+    port = free_port()
+    state_dir = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        KEY_TG=BENCH_TOKEN,
+        TELEGRAM_API_URL=f'http://127.0.0.1:{port}',
+        STATE_DB=os.path.join(state_dir, 'bench_state.db'),
+        # Замеряем пропускную способность, а не троттлинг
+        THROTTLE_BURST=str(10 ** 9),
+    )
+    os.environ.update(env)
+    import bot_telegram as bt
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeBotAPI(latency=args.latency, fail_every=args.fail_every, retry_after=args.retry_after)
+    await api.start(port)
+    results = {}
+    try:
+        results['updates'] = await bench_updates(bt, api, args.updates, args.users)
+        results['fanout'] = [
+            await bench_fanout(bt, api, subscribers, args) for subscribers in args.subscribers
+        ]
+        results['memory'] = bench_memory(bt, args.memory_users)
+        results['startup'] = await bench_startup(bt, args.memory_users, env)
+    finally:
+        await bt.bot.session.close()
+        await api.stop()
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {
+            'latency': args.latency,
+            'fail_every': args.fail_every,
+            'retry_after': args.retry_after,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'batch_size': args.batch_size,
+        },
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for bot_telegram')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--memory-users', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency per call, seconds')
+    parser.add_argument('--fail-every', type=int, default=0, help='answer every Nth sendMessage with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0, help='global messages per second, 0 = unlimited')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report['results'], indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
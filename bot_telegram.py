@@ -1,22 +1,72 @@
+from array import array
 import asyncio
-from datetime import datetime, timedelta
+from bisect import bisect_left
+from collections import deque
+from datetime import date, datetime, timedelta
+from functools import cache
+import heapq
+import hmac
+import itertools
 import logging
 import os
-from aiogram import Bot, Dispatcher, types
+import sqlite3
+import threading
+import time
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError
+)
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from dotenv import load_dotenv
 from aiohttp import web
 import socket
+import sys
 
 load_dotenv()
 
 # Конфигурация
 PORT = int(os.getenv('PORT', 10000))
 KEY_TG = os.getenv('KEY_TG')
+# Адрес своего Bot API сервера (локальный telegram-bot-api или заглушка из bench_bot.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 NAMES = ['Аня', 'Ларик', 'Маша']
+NAME_SET = frozenset(NAMES)
 START_DATE = datetime(2025, 6, 14)
+DUTY_PERIOD = 9
+DUTY_DAYS = [0, 3, 6]
+REMINDER_TIMES = [(12, 0), (18, 0), (21, 0)]
+REMINDER_CATCHUP = timedelta(minutes=int(os.getenv('REMINDER_CATCHUP_MINUTES', 30)))
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', 20))
+SEND_RATE_LIMIT = float(os.getenv('SEND_RATE_LIMIT', 30))
+SEND_CHAT_INTERVAL = float(os.getenv('SEND_CHAT_INTERVAL', 1))
+SEND_BATCH_SIZE = int(os.getenv('SEND_BATCH_SIZE', 500))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+# Входящие апдейты: не больше THROTTLE_RATE в секунду на чат с запасом THROTTLE_BURST
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 1))
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', 5))
+STATE_DB = os.getenv('STATE_DB', 'bot_state.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 0.5))
+# Если задан WEBHOOK_URL, бот получает обновления через вебхук вместо long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+# Несколько воркеров: общий STATE_DB, пользователи делятся на WORKER_COUNT шардов
+WORKER_ID = int(os.getenv('WORKER_ID', 0))
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))
+NODE_ID = os.getenv('NODE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = float(os.getenv('LEASE_TTL', 15))
+DELIVERY_RETENTION = timedelta(days=int(os.getenv('DELIVERY_RETENTION_DAYS', 3)))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800)
 MONTHS_RU = {
     1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля',
     5: 'мая', 6: 'июня', 7: 'июля', 8: 'августа',
@@ -30,19 +80,556 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=KEY_TG)
+def sorted_position(values, value):
+    i = bisect_left(values, value)
+    return i if i < len(values) and values[i] == value else None
+
+class Subscriptions:
+    __slots__ = ('members', 'index', 'by_member')
+
+    def __init__(self, members):
+        self.members = [sys.intern(name) for name in members]
+        self.index = {name: i for i, name in enumerate(self.members)}
+        # Для каждого участника — отсортированные id подписчиков: 8 байт на подписку,
+        # а слот напоминания читает только подписчиков дежурного
+        self.by_member = [array('q') for _ in self.members]
+
+    def __len__(self):
+        return sum(len(user_ids) for user_ids in self.by_member)
+
+    def __contains__(self, user_id):
+        return self.member_of(user_id) is not None
+
+    def member_of(self, user_id):
+        for member, user_ids in enumerate(self.by_member):
+            if sorted_position(user_ids, user_id) is not None:
+                return member
+        return None
+
+    def name_of(self, user_id):
+        member = self.member_of(user_id)
+        return None if member is None else self.members[member]
+
+    def subscribers_of(self, name):
+        return self.by_member[self.index[name]]
+
+    def subscribe(self, user_id, name):
+        member = self.index[name]
+        current = self.member_of(user_id)
+        if current == member:
+            return
+        if current is not None:
+            user_ids = self.by_member[current]
+            del user_ids[bisect_left(user_ids, user_id)]
+        user_ids = self.by_member[member]
+        user_ids.insert(bisect_left(user_ids, user_id), user_id)
+
+    def load(self, items):
+        merged = {
+            user_id: member
+            for member, user_ids in enumerate(self.by_member) for user_id in user_ids
+        }
+        merged.update((user_id, self.index[name]) for user_id, name in items)
+        by_member = [[] for _ in self.members]
+        for user_id, member in merged.items():
+            by_member[member].append(user_id)
+        self.by_member = [array('q', sorted(user_ids)) for user_ids in by_member]
+
+    def clear(self):
+        self.by_member = [array('q') for _ in self.members]
+
+class Confirmations:
+    __slots__ = ('by_day',)
+
+    def __init__(self):
+        # Порядковый номер дня -> отсортированные id подтвердивших; прошедшие дни выбрасываются
+        self.by_day = {}
+
+    def __len__(self):
+        return sum(len(users) for users in self.by_day.values())
+
+    def confirm(self, user_id, day):
+        ordinal = day.toordinal()
+        self.prune(ordinal)
+        users = self.by_day.get(ordinal)
+        if users is None:
+            users = self.by_day[ordinal] = array('q')
+        i = bisect_left(users, user_id)
+        if i == len(users) or users[i] != user_id:
+            users.insert(i, user_id)
+
+    def is_confirmed(self, user_id, day):
+        users = self.by_day.get(day.toordinal())
+        return users is not None and sorted_position(users, user_id) is not None
+
+    def unconfirmed(self, user_ids, day):
+        # Оба списка отсортированы: один проход слиянием вместо поиска на каждого подписчика
+        confirmed = self.by_day.get(day.toordinal(), ())
+        result = []
+        i, count = 0, len(confirmed)
+        for user_id in user_ids:
+            while i < count and confirmed[i] < user_id:
+                i += 1
+            if i == count or confirmed[i] != user_id:
+                result.append(user_id)
+        return result
+
+    def load(self, items):
+        by_day = {}
+        for user_id, day in items:
+            by_day.setdefault(day.toordinal(), set()).add(user_id)
+        for ordinal, users in by_day.items():
+            users.update(self.by_day.get(ordinal, ()))
+            self.by_day[ordinal] = array('q', sorted(users))
+
+    def prune(self, today_ordinal):
+        for ordinal in [ordinal for ordinal in self.by_day if ordinal < today_ordinal]:
+            del self.by_day[ordinal]
+
+    def clear(self):
+        self.by_day.clear()
+
+class Metrics:
+    def __init__(self):
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+
+    def register(self, kind, name, help_text, buckets=None):
+        self.kinds[name] = kind
+        self.help[name] = help_text
+        self.values[name] = {}
+        if buckets:
+            self.buckets[name] = buckets
+
+    def counter(self, name, help_text):
+        self.register('counter', name, help_text)
+
+    def gauge(self, name, help_text):
+        self.register('gauge', name, help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.register('histogram', name, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        series = self.values[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.buckets[name]
+        series = self.values[name]
+        key = tuple(sorted(labels.items()))
+        data = series.get(key)
+        if data is None:
+            data = series[key] = [[0] * len(buckets), 0.0, 0]
+        index = bisect_left(buckets, value)
+        if index < len(buckets):
+            data[0][index] += 1
+        data[1] += value
+        data[2] += 1
+
+    def format_labels(self, key, **extra):
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (
+            (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in pairs
+        )
+        return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+    def render(self):
+        lines = []
+        for name, kind in self.kinds.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in self.values[name].items():
+                if kind != 'histogram':
+                    lines.append(f"{name}{self.format_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets[name], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self.format_labels(key, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{self.format_labels(key, le='+Inf')} {count}")
+                lines.append(f"{name}_sum{self.format_labels(key)} {total}")
+                lines.append(f"{name}_count{self.format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.counter('bot_updates_total', 'Updates received by the dispatcher')
+metrics.histogram('bot_update_duration_seconds', 'Time to process one update')
+metrics.histogram('bot_handler_duration_seconds', 'Handler latency')
+metrics.counter('bot_handler_errors_total', 'Handlers that raised an exception')
+metrics.histogram('bot_api_request_duration_seconds', 'Telegram Bot API call latency')
+metrics.counter('bot_api_errors_total', 'Failed Telegram Bot API calls')
+metrics.histogram('bot_reminder_job_duration_seconds', 'Time to deliver one reminder slot', LAG_BUCKETS)
+metrics.histogram('bot_reminder_lag_seconds', 'Delay between the scheduled and actual reminder time', LAG_BUCKETS)
+metrics.counter('bot_reminder_missed_slots_total', 'Reminder slots skipped as too old')
+metrics.counter('bot_reminder_recipients_total', 'Reminder messages attempted')
+metrics.gauge('bot_reminder_last_recipients', 'Recipients of the latest reminder slot')
+metrics.counter('bot_reminder_send_failures_total', 'Reminder messages that could not be delivered')
+metrics.gauge('bot_update_queue_size', 'Webhook updates waiting for a worker')
+metrics.counter('bot_updates_throttled_total', 'Updates dropped by the per-chat throttle')
+metrics.counter('bot_confirmations_deduplicated_total', 'Repeated duty confirmations answered without a handler')
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        metrics.inc('bot_updates_total', type=event.event_type)
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe('bot_update_duration_seconds', time.monotonic() - started, type=event.event_type)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('bot_handler_duration_seconds', time.monotonic() - started, handler=name)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc('bot_api_errors_total', method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('bot_api_request_duration_seconds', time.monotonic() - started, method=name)
+
+class UpdatePipelineMiddleware(BaseMiddleware):
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.prune_at = 10000
+        self.locks = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        chat = data.get('event_chat')
+        if not self.allow(chat.id if chat else user.id):
+            metrics.inc('bot_updates_throttled_total')
+            if event.callback_query:
+                # Иначе у пользователя так и крутятся «часики» на кнопке
+                try:
+                    await event.callback_query.answer("Слишком много запросов, попробуй чуть позже ⏳")
+                except TelegramAPIError as e:
+                    logger.warning(f"Failed to answer throttled callback for {user.id}: {e}")
+            return None
+
+        # Апдейты разных пользователей идут параллельно, одного пользователя — по порядку
+        entry = self.locks.get(user.id)
+        if entry is None:
+            entry = self.locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if self.is_repeated_confirmation(event, user.id):
+                    metrics.inc('bot_confirmations_deduplicated_total')
+                    await event.callback_query.answer("Дежурство уже подтверждено ✅")
+                    return None
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[user.id]
+
+    def allow(self, chat_id):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[chat_id] = (tokens, now)
+            return False
+        self.buckets[chat_id] = (tokens - 1, now)
+        if len(self.buckets) > self.prune_at:
+            self.prune(now)
+        return True
+
+    def prune(self, now):
+        # Полностью восстановившиеся корзины ничем не отличаются от отсутствующих
+        self.buckets = {
+            chat_id: (tokens, updated) for chat_id, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate < self.burst
+        }
+        self.prune_at = max(10000, 2 * len(self.buckets))
+
+    def is_repeated_confirmation(self, event, user_id):
+        callback = event.callback_query
+        return (
+            callback is not None and callback.data == "confirm_duty"
+            and confirmations.is_confirmed(user_id, date.today())
+        )
+
+class Rotation:
+    def __init__(self, members, start_date, period, duty_days, skip_days=(), swaps=None):
+        self.members = list(members)
+        self.index = {name: i for i, name in enumerate(self.members)}
+        self.start = start_date.toordinal()
+        self.period = period
+        self.table = [None] * period
+        for position, offset in enumerate(duty_days):
+            self.table[offset] = position % len(self.members)
+        self.slots = [(offset, member) for offset, member in enumerate(self.table) if member is not None]
+
+        # Пропуски (None) и замены (индекс участника) на конкретные даты
+        self.overrides = {day.toordinal(): None for day in skip_days}
+        for day, name in (swaps or {}).items():
+            self.overrides[day.toordinal()] = self.index[name]
+        self.swap_days = [[] for _ in self.members]
+        for ordinal, member in sorted(self.overrides.items()):
+            if member is not None:
+                self.swap_days[member].append(ordinal)
+        self.all_swap_days = sorted(o for o, m in self.overrides.items() if m is not None)
+
+        # Для каждого дня цикла: через сколько дней ближайшее дежурство
+        self.member_offsets = [self.build_offsets({member}) for member in range(len(self.members))]
+        self.any_offsets = self.build_offsets(set(range(len(self.members))))
+
+    def build_offsets(self, members):
+        offsets = [None] * self.period
+        following = None
+        for cycle_day in reversed(range(2 * self.period)):
+            if self.table[cycle_day % self.period] in members:
+                following = cycle_day
+            if cycle_day < self.period and following is not None:
+                offsets[cycle_day] = following - cycle_day
+        return offsets
+
+    def member_at(self, ordinal):
+        if ordinal in self.overrides:
+            return self.overrides[ordinal]
+        return self.table[(ordinal - self.start) % self.period]
+
+    def member_on(self, day):
+        member = self.member_at(day.toordinal())
+        return None if member is None else self.members[member]
+
+    def next_duty_ordinal(self, ordinal, member=None):
+        if member is None:
+            offsets, swaps = self.any_offsets, self.all_swap_days
+        else:
+            offsets, swaps = self.member_offsets[member], self.swap_days[member]
+        for _ in range(len(self.overrides) + 1):
+            offset = offsets[(ordinal - self.start) % self.period]
+            candidate = None if offset is None else ordinal + offset
+            i = bisect_left(swaps, ordinal)
+            if i < len(swaps) and (candidate is None or swaps[i] <= candidate):
+                return swaps[i]
+            if candidate is None or candidate not in self.overrides:
+                return candidate
+            ordinal = candidate + 1
+        return None
+
+    def next_duty(self, day, name=None):
+        member = None if name is None else self.index[name]
+        ordinal = self.next_duty_ordinal(day.toordinal(), member)
+        return None if ordinal is None else date.fromordinal(ordinal)
+
+    def next_duties(self, name, day, count):
+        member = self.index[name]
+        duties = []
+        ordinal = day.toordinal()
+        while len(duties) < count:
+            ordinal = self.next_duty_ordinal(ordinal, member)
+            if ordinal is None:
+                break
+            duties.append(date.fromordinal(ordinal))
+            ordinal += 1
+        return duties
+
+    def duties_between(self, first_day, last_day):
+        first, last = first_day.toordinal(), last_day.toordinal()
+        cycle_start = first - (first - self.start) % self.period
+        duties = [
+            (cycle + offset, member)
+            for cycle in range(cycle_start, last + 1, self.period)
+            for offset, member in self.slots
+            if first <= cycle + offset <= last and cycle + offset not in self.overrides
+        ]
+        duties.extend(
+            (ordinal, member) for ordinal, member in self.overrides.items()
+            if member is not None and first <= ordinal <= last
+        )
+        duties.sort()
+        return [(date.fromordinal(ordinal), self.members[member]) for ordinal, member in duties]
+
+class ScheduleEngine:
+    def __init__(self):
+        self.rotations = {}
+
+    def add(self, key, rotation):
+        self.rotations[key] = rotation
+        return rotation
+
+    def get(self, key):
+        return self.rotations[key]
+
+    def on_duty(self, day):
+        ordinal = day.toordinal()
+        return {
+            key: None if (member := rotation.member_at(ordinal)) is None else rotation.members[member]
+            for key, rotation in self.rotations.items()
+        }
+
+    def duties_between(self, first_day, last_day):
+        return {
+            key: rotation.duties_between(first_day, last_day)
+            for key, rotation in self.rotations.items()
+        }
+
+    def next_duties(self, key, name, day, count=1):
+        return self.rotations[key].next_duties(name, day, count)
+
+bot = Bot(
+    token=KEY_TG,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+bot.session.middleware(ApiMetricsMiddleware())
 dp = Dispatcher()
-user_data = {}
-confirmed_duties = {}
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.update.outer_middleware(UpdatePipelineMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+schedule = ScheduleEngine()
+rotation = schedule.add('default', Rotation(NAMES, START_DATE, DUTY_PERIOD, DUTY_DAYS))
+subscriptions = Subscriptions(NAMES)
+confirmations = Confirmations()
+user_reminder_times = {}
+# Последний отправленный слот: ключ 0 — общие напоминания, иначе id пользователя
+delivered_slots = {}
+
+def update_user_id(data):
+    # Автор апдейта лежит в поле 'from' (у poll_answer — 'user') вложенного объекта
+    for key, value in data.items():
+        if key != 'update_id' and isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            return user.get('id') if isinstance(user, dict) else None
+    return None
+
+class WebhookUpdates:
+    def __init__(self, size=UPDATE_QUEUE_SIZE, workers=UPDATE_WORKERS, remember=10000):
+        self.queue = asyncio.Queue()
+        # Место занимает апдейт и в общей очереди, и в очереди пользователя
+        self.slots = asyncio.Semaphore(size)
+        self.size = size
+        self.waiting = 0
+        self.backlogs = {}
+        self.workers = workers
+        self.tasks = []
+        self.seen = set()
+        self.seen_order = deque(maxlen=remember)
+
+    async def handle(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict) or type(data.get('update_id')) is not int:
+            return web.Response(status=400)
+
+        update_id = data['update_id']
+        if update_id in self.seen:
+            return web.Response()
+        self.remember(update_id)
+        if self.waiting >= self.size:
+            # Не отвечаем, пока не освободится место: Telegram не шлёт больше max_connections запросов
+            logger.warning("Update queue is full, holding webhook request")
+        try:
+            await self.slots.acquire()
+        except asyncio.CancelledError:
+            self.seen.discard(update_id)
+            raise
+        self.waiting += 1
+        self.queue.put_nowait(data)
+        return web.Response()
+
+    def remember(self, update_id):
+        if len(self.seen_order) == self.seen_order.maxlen:
+            self.seen.discard(self.seen_order[0])
+        self.seen_order.append(update_id)
+        self.seen.add(update_id)
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def worker(self):
+        while True:
+            data = await self.queue.get()
+            user_id = update_user_id(data)
+            if user_id is None:
+                await self.process(data)
+                continue
+            backlog = self.backlogs.get(user_id)
+            if backlog is not None:
+                # Пользователя уже обслуживает другой воркер: он обработает апдейт по порядку,
+                # а этот не простаивает в ожидании и берёт следующий
+                backlog.append(data)
+                continue
+            backlog = self.backlogs[user_id] = deque([data])
+            try:
+                while backlog:
+                    await self.process(backlog[0])
+                    backlog.popleft()
+            finally:
+                del self.backlogs[user_id]
+
+    async def process(self, data):
+        try:
+            await dp.feed_raw_update(bot, data)
+        except Exception as e:
+            logger.error(f"Update handling error: {e}")
+        finally:
+            self.waiting -= 1
+            self.slots.release()
+            self.queue.task_done()
+
+    async def stop(self, timeout=10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.waiting} queued updates on shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
 class WebServer:
-    def __init__(self):
+    def __init__(self, webhook=None):
         self.runner = None
         self.site = None
+        self.webhook = webhook
+        self.ready = False
 
     async def start(self):
         app = web.Application()
         app.router.add_get('/', self.health_check)
+        app.router.add_get('/livez', self.liveness)
+        app.router.add_get('/readyz', self.readiness)
+        app.router.add_get('/metrics', self.metrics)
+        if self.webhook:
+            app.router.add_post(WEBHOOK_PATH, self.webhook.handle)
         self.runner = web.AppRunner(app)
         await self.runner.setup()
         
@@ -63,52 +650,643 @@ class WebServer:
     async def health_check(self, request):
         return web.Response(text="Bot is running")
 
+    async def liveness(self, request):
+        return web.Response(text="ok")
+
+    async def readiness(self, request):
+        if self.ready and reminder.task and not reminder.task.done():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="not ready")
+
+    async def metrics(self, request):
+        if self.webhook:
+            metrics.set('bot_update_queue_size', self.webhook.waiting)
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
     async def stop(self):
         if self.site:
             await self.site.stop()
         if self.runner:
             await self.runner.cleanup()
 
+class SqliteBackend:
+    TABLES = ('subscriptions', 'confirmations', 'reminder_times', 'delivered_slots')
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        # Соединение одно на все потоки to_thread, поэтому вызовы идут строго по одному.
+        # Замок берётся в самом потоке: отмена ожидающей задачи его не отпускает
+        self.lock = threading.Lock()
+
+    def locked(self, method, *args):
+        with self.lock:
+            return method(*args)
+
+    def open(self):
+        if self.conn:
+            return
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            for table in self.TABLES:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (user_id INTEGER PRIMARY KEY, value TEXT NOT NULL)"
+                )
+
+    def load(self):
+        return {
+            table: self.conn.execute(f"SELECT user_id, value FROM {table}").fetchall()
+            for table in self.TABLES
+        }
+
+    def apply(self, ops):
+        upserts = {table: [] for table in self.TABLES}
+        deletes = {table: [] for table in self.TABLES}
+        for (table, user_id), value in ops.items():
+            if value is None:
+                deletes[table].append((user_id,))
+            else:
+                upserts[table].append((user_id, value))
+        with self.conn:
+            for table in self.TABLES:
+                if upserts[table]:
+                    self.conn.executemany(
+                        f"INSERT OR REPLACE INTO {table} (user_id, value) VALUES (?, ?)", upserts[table]
+                    )
+                if deletes[table]:
+                    self.conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", deletes[table])
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class SqliteCoordinator(SqliteBackend):
+    def open(self):
+        if self.conn:
+            return
+        super().open()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fanout_jobs (slot TEXT NOT NULL, shard INTEGER NOT NULL, "
+                "run_at TEXT NOT NULL, user_id INTEGER, done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (slot, shard))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries (slot TEXT NOT NULL, user_id INTEGER NOT NULL, "
+                "shard INTEGER NOT NULL, status TEXT NOT NULL, PRIMARY KEY (slot, user_id))"
+            )
+
+    def acquire(self, name, holder, ttl):
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now)
+            )
+            row = self.conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    def release(self, name, holder):
+        with self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def enqueue(self, slot, run_at, user_id, shards):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO fanout_jobs (slot, shard, run_at, user_id) VALUES (?, ?, ?, ?)",
+                [(slot, shard, run_at, user_id) for shard in shards]
+            )
+
+    def pending_jobs(self, shard):
+        return self.conn.execute(
+            "SELECT slot, run_at, user_id FROM fanout_jobs WHERE shard = ? AND done = 0 ORDER BY run_at",
+            (shard,)
+        ).fetchall()
+
+    def recipients(self, slot, shard, shards, name, day, user_id, limit):
+        query = (
+            "SELECT s.user_id FROM subscriptions s "
+            "WHERE s.value = ? AND abs(s.user_id) % ? = ? "
+            "AND NOT EXISTS (SELECT 1 FROM confirmations c WHERE c.user_id = s.user_id AND c.value = ?) "
+            "AND NOT EXISTS (SELECT 1 FROM deliveries d WHERE d.slot = ? AND d.user_id = s.user_id) "
+        )
+        params = [name, shards, shard, day, slot]
+        if user_id is None:
+            query += "AND NOT EXISTS (SELECT 1 FROM reminder_times r WHERE r.user_id = s.user_id) "
+        else:
+            query += "AND s.user_id = ? "
+            params.append(user_id)
+        query += "LIMIT ?"
+        params.append(limit)
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    def claim(self, slot, shard, user_id):
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO deliveries (slot, user_id, shard, status) VALUES (?, ?, ?, 'sending')",
+                (slot, user_id, shard)
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, slot, user_id, status):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE deliveries SET status = ? WHERE slot = ? AND user_id = ?", (status, slot, user_id)
+            )
+
+    def abandon_in_flight(self, slot, shard):
+        with self.conn:
+            cursor = self.conn.execute(
+                "UPDATE deliveries SET status = 'unknown' WHERE slot = ? AND shard = ? AND status = 'sending'",
+                (slot, shard)
+            )
+        return cursor.rowcount
+
+    def complete(self, slot, shard):
+        with self.conn:
+            self.conn.execute("UPDATE fanout_jobs SET done = 1 WHERE slot = ? AND shard = ?", (slot, shard))
+
+    def prune(self, before):
+        with self.conn:
+            self.conn.execute("DELETE FROM deliveries WHERE slot < ?", (before,))
+            self.conn.execute("DELETE FROM fanout_jobs WHERE done = 1 AND run_at < ?", (before,))
+
+class Cluster:
+    def __init__(self, coordinator, node_id=NODE_ID, shard=WORKER_ID, shards=WORKER_COUNT):
+        self.coordinator = coordinator
+        self.node_id = node_id
+        self.shard = shard
+        self.shards = shards
+        self.is_leader = False
+        self.renewed_at = 0.0
+        self.lease_renewed = 0.0
+        self.lease_held = False
+        self.elected = asyncio.Event()
+        self.demoted = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    async def start(self):
+        await self.db(self.coordinator.open)
+        self.demoted.set()
+        self.tasks = [asyncio.create_task(self.heartbeat()), asyncio.create_task(self.work())]
+
+    async def db(self, method, *args):
+        return await asyncio.to_thread(self.coordinator.locked, method, *args)
+
+    async def acquire(self, name):
+        return await self.db(self.coordinator.acquire, name, self.node_id, LEASE_TTL)
+
+    async def heartbeat(self):
+        while True:
+            attempt = time.monotonic()
+            try:
+                leader = await asyncio.wait_for(self.acquire('leader'), timeout=LEASE_TTL / 3)
+                if leader:
+                    self.renewed_at = attempt
+                self.set_leader(leader)
+                await self.acquire(f'shard:{self.shard}')
+                if leader:
+                    before = (datetime.now() - DELIVERY_RETENTION).isoformat(timespec='minutes')
+                    await self.db(self.coordinator.prune, before)
+            except Exception as e:
+                logger.error(f"Lease heartbeat error: {e}")
+                # Не смогли продлить аренду: уступаем раньше, чем её заберёт другой узел
+                if self.is_leader and time.monotonic() - self.renewed_at >= LEASE_TTL * 2 / 3:
+                    self.set_leader(False)
+            await asyncio.sleep(LEASE_TTL / 3)
+
+    def set_leader(self, leader):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        logger.info(f"Node {self.node_id} {'is now the leader' if leader else 'lost leadership'}")
+        if leader:
+            self.demoted.clear()
+            self.elected.set()
+        else:
+            self.elected.clear()
+            self.demoted.set()
+
+    async def enqueue(self, when, user_id=None):
+        slot = when.isoformat(timespec='minutes')
+        if user_id is not None:
+            slot += f"#{user_id}"
+            shards = [abs(user_id) % self.shards]
+        else:
+            shards = range(self.shards)
+        await self.db(self.coordinator.enqueue, slot, when.isoformat(), user_id, shards)
+        self.wakeup.set()
+
+    async def work(self):
+        while True:
+            self.wakeup.clear()
+            for shard in range(self.shards):
+                try:
+                    await self.process_shard(shard)
+                except Exception as e:
+                    logger.error(f"Shard {shard} processing error: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=LEASE_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_shard(self, shard):
+        jobs = await self.db(self.coordinator.pending_jobs, shard)
+        if not jobs:
+            return
+        # Чужой шард забираем, только если его владелец не продлевает аренду
+        lease = f'shard:{shard}'
+        if not await self.acquire(lease):
+            return
+        try:
+            for slot, run_at, user_id in jobs:
+                if not await self.run_job(lease, slot, shard, datetime.fromisoformat(run_at), user_id):
+                    return
+        finally:
+            if shard != self.shard:
+                await self.db(self.coordinator.release, lease, self.node_id)
+
+    async def run_job(self, lease, slot, shard, when, user_id):
+        # Как и в одиночном режиме: слот, пролежавший дольше REMINDER_CATCHUP, не шлём с устаревшей датой
+        if (datetime.now() - when).total_seconds() > REMINDER_CATCHUP.total_seconds():
+            logger.warning(f"Skipping missed reminder slot {slot} shard {shard}")
+            metrics.inc('bot_reminder_missed_slots_total')
+            await self.db(self.coordinator.complete, slot, shard)
+            return True
+        today = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        name = duty_name_on(today)
+        started = time.monotonic()
+        total = failed = 0
+        # Мы держим аренду шарда, значит 'sending' остались от упавшего узла
+        abandoned = await self.db(self.coordinator.abandon_in_flight, slot, shard)
+        if abandoned:
+            logger.warning(f"Slot {slot} shard {shard}: {abandoned} in-flight reminders of a lost node not retried")
+        text = reminder.reminder_text(name, today) if name else None
+        self.lease_renewed, self.lease_held = time.monotonic(), True
+        while name is not None:
+            batch = await self.db(
+                self.coordinator.recipients, slot, shard, self.shards, name,
+                today.date().isoformat(), user_id, reminder.sender.batch_size
+            )
+            if not batch:
+                break
+            results = await asyncio.gather(
+                *(self.deliver(lease, slot, shard, recipient, text) for recipient in batch)
+            )
+            attempted = [ok for ok in results if ok is not None]
+            total += len(attempted)
+            failed += attempted.count(False)
+            if not self.lease_held:
+                logger.warning(f"Lost lease {lease}, leaving {slot} to another node")
+                metrics.inc('bot_reminder_recipients_total', total)
+                metrics.inc('bot_reminder_send_failures_total', failed)
+                return False
+        await self.db(self.coordinator.complete, slot, shard)
+        metrics.inc('bot_reminder_recipients_total', total)
+        metrics.inc('bot_reminder_send_failures_total', failed)
+        logger.info(f"Slot {slot} shard {shard}: {total - failed} sent, {failed} failed in {time.monotonic() - started:.2f}s")
+        return True
+
+    async def deliver(self, lease, slot, shard, recipient, text):
+        sender = reminder.sender
+        async with sender.semaphore:
+            if not await self.hold_lease(lease):
+                return None
+            # Отметка ставится прямо перед отправкой, поэтому повторов не бывает.
+            # Цена — при падении узла теряются сообщения в полёте, не больше SEND_CONCURRENCY
+            if not await self.db(self.coordinator.claim, slot, shard, recipient):
+                return None
+            ok = await sender.send(recipient, text, reminder.get_confirmation_keyboard())
+            await self.db(self.coordinator.finish, slot, recipient, 'sent' if ok else 'failed')
+            return ok
+
+    async def hold_lease(self, lease):
+        if self.lease_held and time.monotonic() - self.lease_renewed >= LEASE_TTL / 3:
+            # Продлевает одна задача, остальные тем временем работают по ещё действующей аренде
+            self.lease_renewed = time.monotonic()
+            try:
+                self.lease_held = await self.acquire(lease)
+            except Exception as e:
+                logger.error(f"Lease {lease} renewal error: {e}")
+                self.lease_held = False
+        return self.lease_held
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.is_leader:
+            await self.db(self.coordinator.release, 'leader', self.node_id)
+        await self.db(self.coordinator.release, f'shard:{self.shard}', self.node_id)
+        await self.db(self.coordinator.close)
+
+class StateStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.pending = {}
+        self.task = None
+        self.stop_event = asyncio.Event()
+        # Пачки уходят в базу в порядке снятия; само соединение защищает замок бэкенда
+        self.lock = asyncio.Lock()
+
+    async def db(self, method, *args):
+        return await asyncio.to_thread(self.backend.locked, method, *args)
+
+    async def load(self):
+        started = time.monotonic()
+        async with self.lock:
+            await self.db(self.backend.open)
+            state = await self.db(self.backend.load)
+        subscriptions.load(
+            (user_id, name) for user_id, name in state['subscriptions'] if name in subscriptions.index
+        )
+        today = date.today()
+        current = []
+        for user_id, day in state['confirmations']:
+            day = date.fromisoformat(day)
+            if day < today:
+                self.put('confirmations', user_id, None)
+            else:
+                current.append((user_id, day))
+        confirmations.load(current)
+        for user_id, times in state['reminder_times']:
+            try:
+                user_reminder_times[user_id] = parse_reminder_times(times)
+            except ValueError:
+                # Пустое время могло сохраниться раньше: возвращаем стандартные напоминания
+                self.put('reminder_times', user_id, None)
+        for key, slot in state['delivered_slots']:
+            delivered_slots[key] = datetime.fromisoformat(slot)
+        logger.info(f"Loaded {len(subscriptions)} subscriptions in {time.monotonic() - started:.3f}s")
+
+    def put(self, table, user_id, value):
+        self.pending[(table, user_id)] = value
+
+    async def start(self):
+        self.stop_event.clear()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=STATE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            ops, self.pending = self.pending, {}
+            try:
+                await self.db(self.backend.apply, ops)
+            except Exception as e:
+                logger.error(f"State flush error: {e}")
+                for key, value in ops.items():
+                    self.pending.setdefault(key, value)
+
+    async def stop(self):
+        self.stop_event.set()
+        if self.task:
+            await self.task
+        await self.flush()
+        await self.db(self.backend.close)
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            wait = max(self.next_slot, self.paused_until) - now
+            if wait <= 0:
+                self.next_slot = max(now, self.next_slot) + self.interval
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class FanOutSender:
+    def __init__(self, concurrency=SEND_CONCURRENCY, rate=SEND_RATE_LIMIT,
+                 chat_interval=SEND_CHAT_INTERVAL, batch_size=SEND_BATCH_SIZE):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+        self.chat_interval = chat_interval
+        self.batch_size = batch_size
+        self.chat_last_sent = {}
+
+    async def send_all(self, chat_ids, text, reply_markup=None):
+        chat_ids = list(chat_ids)
+        sent = 0
+        for number, start in enumerate(range(0, len(chat_ids), self.batch_size), 1):
+            batch = chat_ids[start:start + self.batch_size]
+            started = time.monotonic()
+            results = await asyncio.gather(
+                *(self.send_one(chat_id, text, reply_markup) for chat_id in batch)
+            )
+            batch_sent = sum(results)
+            sent += batch_sent
+            logger.info(
+                f"Fan-out batch {number}: {batch_sent}/{len(batch)} sent "
+                f"in {time.monotonic() - started:.2f}s"
+            )
+        self.prune_chats()
+        return sent, len(chat_ids) - sent
+
+    async def send_one(self, chat_id, text, reply_markup=None):
+        async with self.semaphore:
+            return await self.send(chat_id, text, reply_markup)
+
+    async def send(self, chat_id, text, reply_markup=None):
+        # Вызывающий уже держит self.semaphore
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self.wait_for_chat(chat_id)
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                self.chat_last_sent[chat_id] = time.monotonic()
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control, retry after {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                logger.info(f"Chat {chat_id} blocked the bot")
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Send to {chat_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Send message error: {e}")
+                return False
+        logger.error(f"Giving up on chat {chat_id} after {SEND_MAX_RETRIES + 1} attempts")
+        return False
+
+    async def wait_for_chat(self, chat_id):
+        last = self.chat_last_sent.get(chat_id)
+        if last is not None:
+            wait = last + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def prune_chats(self):
+        cutoff = time.monotonic() - self.chat_interval
+        self.chat_last_sent = {
+            chat_id: sent_at for chat_id, sent_at in self.chat_last_sent.items() if sent_at > cutoff
+        }
+
 class DutyReminder:
     def __init__(self):
         self.task = None
         self.stop_flag = False
+        self.sender = FanOutSender()
+        self.cluster = None
+        self.queue = []
+        self.counter = itertools.count()
+        self.user_slots = {}
+        self.wakeup = asyncio.Event()
 
     async def start(self):
         self.stop_flag = False
+        self.queue = []
+        self.user_slots = {}
+        # Догоняем только слоты после последнего отправленного, чтобы рестарт не слал их повторно
+        since = datetime.now() - REMINDER_CATCHUP
+        self.schedule(None, max(since, delivered_slots.get(0, since)))
+        for user_id in user_reminder_times:
+            self.user_slots[user_id] = next(self.counter)
+            self.schedule(user_id, max(since, delivered_slots.get(user_id, since)))
         self.task = asyncio.create_task(self.run_reminders())
 
+    def next_reminder(self, user_id, after):
+        if user_id is None:
+            name, times = None, REMINDER_TIMES
+        else:
+            name, times = subscriptions.name_of(user_id), user_reminder_times.get(user_id)
+            if name is None or not times:
+                return None
+        day = after.replace(hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(2):
+            day = next_duty_day(day, name)
+            if day is None:
+                return None
+            for hour, minute in sorted(times):
+                when = day.replace(hour=hour, minute=minute)
+                if when > after:
+                    return when
+            day += timedelta(days=1)
+        return None
+
+    def schedule(self, user_id, after):
+        token = self.user_slots.get(user_id)
+        if user_id is not None and token is None:
+            return
+        when = self.next_reminder(user_id, after)
+        if when is None:
+            return
+        heapq.heappush(self.queue, (when, next(self.counter), user_id, token))
+        if self.queue[0][0] == when:
+            self.wakeup.set()
+
+    def reschedule_user(self, user_id):
+        if user_id in user_reminder_times:
+            self.user_slots[user_id] = next(self.counter)
+            self.schedule(user_id, datetime.now())
+        else:
+            self.user_slots.pop(user_id, None)
+
     async def run_reminders(self):
         while not self.stop_flag:
-            now = datetime.now()
-            if now.minute == 0 and now.hour in [12, 18, 21]:
-                await self.send_reminders()
-            await asyncio.sleep(60)
+            self.wakeup.clear()
+            if not self.queue:
+                await self.wakeup.wait()
+                continue
+            delay = (self.queue[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                # Ограничиваем сон, чтобы переводы системных часов не сдвигали напоминания
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(delay, 3600))
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-    async def send_reminders(self):
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        days_since_start = (today - START_DATE).days
-        cycle_day = days_since_start % 9
-        
-        if cycle_day in [0, 3, 6]:
-            current_duty_name = NAMES[cycle_day // 3]
-            formatted_date = self.format_date(today)
-            
-            for user_id, name in user_data.items():
-                if name == current_duty_name and confirmed_duties.get(user_id) != today:
-                    try:
-                        await bot.send_message(
-                            user_id,
-                            f"Напоминание: {name}, сегодня ({formatted_date}) ты дежуришь в ванной! 🛁",
-                            reply_markup=self.get_confirmation_keyboard()
-                        )
-                    except Exception as e:
-                        logger.error(f"Send message error: {e}")
+            when, _, user_id, token = heapq.heappop(self.queue)
+            if user_id is not None and self.user_slots.get(user_id) != token:
+                continue
+            self.schedule(user_id, when)
+            lag = (datetime.now() - when).total_seconds()
+            if lag > REMINDER_CATCHUP.total_seconds():
+                logger.warning(f"Skipping missed reminder slot {when:%Y-%m-%d %H:%M}")
+                metrics.inc('bot_reminder_missed_slots_total')
+                continue
+            metrics.observe('bot_reminder_lag_seconds', max(lag, 0))
+            started = time.monotonic()
+            try:
+                await self.mark_delivered(user_id, when)
+                if self.cluster:
+                    await self.cluster.enqueue(when, user_id)
+                else:
+                    await self.send_reminders(when, user_id)
+            except Exception as e:
+                logger.error(f"Reminder slot {when:%Y-%m-%d %H:%M} failed: {e}")
+            metrics.observe('bot_reminder_job_duration_seconds', time.monotonic() - started)
+
+    async def mark_delivered(self, user_id, when):
+        key = 0 if user_id is None else user_id
+        delivered_slots[key] = when
+        store.put('delivered_slots', key, when.isoformat(timespec='minutes'))
+        await store.flush()
+
+    async def send_reminders(self, when, user_id=None):
+        today = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        current_duty_name = duty_name_on(today)
+        if current_duty_name is None:
+            return
+
+        confirmations.prune(today.toordinal())
+        if user_id is None:
+            candidates = subscriptions.subscribers_of(current_duty_name)
+        else:
+            candidates = [user_id] if subscriptions.name_of(user_id) == current_duty_name else []
+        recipients = [
+            uid for uid in confirmations.unconfirmed(candidates, today)
+            if user_id is not None or uid not in user_reminder_times
+        ]
+        if user_id is None:
+            metrics.set('bot_reminder_last_recipients', len(recipients))
+        if not recipients:
+            return
+
+        sent, failed = await self.sender.send_all(
+            recipients,
+            self.reminder_text(current_duty_name, today),
+            reply_markup=self.get_confirmation_keyboard()
+        )
+        metrics.inc('bot_reminder_recipients_total', len(recipients))
+        metrics.inc('bot_reminder_send_failures_total', failed)
+        logger.info(f"Reminder for {current_duty_name}: {sent} sent, {failed} failed")
+
+    def reminder_text(self, name, day):
+        return f"Напоминание: {name}, сегодня ({self.format_date(day)}) ты дежуришь в ванной! 🛁"
 
     def format_date(self, date):
         return f"{date.day} {MONTHS_RU[date.month]}"
 
-    def get_confirmation_keyboard(self):
+    @staticmethod
+    @cache
+    def get_confirmation_keyboard():
         return InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Иду дежурить! ✅", callback_data="confirm_duty")]
         ])
@@ -122,6 +1300,9 @@ class DutyReminder:
             except asyncio.CancelledError:
                 pass
 
+reminder = DutyReminder()
+store = StateStore(SqliteBackend(STATE_DB))
+
 # Handlers
 @dp.message(Command("start"))
 async def start_command(message: types.Message):
@@ -131,19 +1312,27 @@ async def start_command(message: types.Message):
         reply_markup=get_names_keyboard()
     )
 
+@cache
 def get_names_keyboard():
     builder = ReplyKeyboardBuilder()
     for name in NAMES:
         builder.add(KeyboardButton(text=name))
     return builder.as_markup(resize_keyboard=True)
 
-@dp.message(lambda message: message.text in NAMES)
+@dp.message(F.text.in_(NAME_SET))
 async def handle_name_selection(message: types.Message):
     user_id = message.from_user.id
     selected_name = message.text
-    user_data[user_id] = selected_name
+    subscribe_user(user_id, selected_name)
     
     _, next_duty = get_next_duty(selected_name)
+    if next_duty is None:
+        await message.answer(
+            f"Вы выбрали расписание для {selected_name}. "
+            "Ближайших дежурств по графику нет.",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        return
     formatted_date = format_date_ru(next_duty)
     
     await message.answer(
@@ -152,33 +1341,138 @@ async def handle_name_selection(message: types.Message):
         reply_markup=types.ReplyKeyboardRemove()
     )
 
-def get_next_duty(name):
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    days_since_start = (today - START_DATE).days
-    cycle_day = days_since_start % 9
-    index = NAMES.index(name)
-    days_until = (9 - cycle_day + (index * 3)) % 9
-    return None, today + timedelta(days=days_until)
+def subscribe_user(user_id, name):
+    subscriptions.subscribe(user_id, name)
+    store.put('subscriptions', user_id, name)
+    reminder.reschedule_user(user_id)
+
+def get_next_duty(name, today=None):
+    if today is None:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return None, next_duty_day(today, name)
+
+def duty_name_on(day):
+    return rotation.member_on(day)
+
+def next_duty_day(day, name=None):
+    duty_day = rotation.next_duty(day, name)
+    if duty_day is None:
+        return None
+    return datetime.combine(duty_day, datetime.min.time())
+
+def parse_reminder_times(args):
+    times = set()
+    for item in args.replace(',', ' ').split():
+        hour, _, minute = item.partition(':')
+        hour, minute = int(hour), int(minute or 0)
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(item)
+        times.add((hour, minute))
+    if not times:
+        raise ValueError(args)
+    return sorted(times)
+
+@dp.message(Command("remind"))
+async def set_reminder_times(message: types.Message):
+    user_id = message.from_user.id
+    args = (message.text or '').partition(' ')[2]
+    if not args.strip():
+        user_reminder_times.pop(user_id, None)
+        delivered_slots.pop(user_id, None)
+        store.put('reminder_times', user_id, None)
+        store.put('delivered_slots', user_id, None)
+        reminder.reschedule_user(user_id)
+        await message.answer("Напоминания придут в стандартное время: 12:00, 18:00 и 21:00.")
+        return
+    try:
+        times = parse_reminder_times(args)
+    except ValueError:
+        await message.answer("Не понял время. Пример: /remind 9:30 20:00")
+        return
+    user_reminder_times[user_id] = times
+    formatted = ', '.join(f"{hour}:{minute:02d}" for hour, minute in times)
+    store.put('reminder_times', user_id, formatted)
+    reminder.reschedule_user(user_id)
+    await message.answer(f"Буду напоминать в дни дежурства в {formatted}.")
 
 def format_date_ru(date):
     return f"{date.day} {MONTHS_RU[date.month]}"
 
-@dp.callback_query(lambda c: c.data == "confirm_duty")
+@dp.callback_query(F.data == "confirm_duty")
 async def confirm_duty(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    confirmed_duties[user_id] = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    confirmations.confirm(user_id, today)
+    store.put('confirmations', user_id, today.date().isoformat())
     await callback.message.edit_text("✅ Дежурство подтверждено!")
     await callback.answer()
 
+async def receive_updates(updates, webserver, port):
+    if updates:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set, receiving updates on port {port}{WEBHOOK_PATH}")
+        webserver.ready = True
+        await asyncio.Event().wait()
+    else:
+        await bot.delete_webhook()
+        logger.info("Starting bot polling...")
+        webserver.ready = True
+        await dp.start_polling(bot, close_bot_session=False)
+
+async def lead(cluster, updates, webserver, port):
+    # Обновления принимает и напоминания планирует только лидер
+    while True:
+        await cluster.elected.wait()
+        subscriptions.clear()
+        confirmations.clear()
+        user_reminder_times.clear()
+        delivered_slots.clear()
+        await store.load()
+        await reminder.start()
+        serving = asyncio.create_task(receive_updates(updates, webserver, port))
+        demoted = asyncio.create_task(cluster.demoted.wait())
+        await asyncio.wait([serving, demoted], return_when=asyncio.FIRST_COMPLETED)
+        webserver.ready = False
+        demoted.cancel()
+        if not serving.done():
+            try:
+                await dp.stop_polling()
+            except RuntimeError:
+                serving.cancel()
+        await asyncio.gather(serving, demoted, return_exceptions=True)
+        await reminder.stop()
+        await store.flush()
+        if serving.done() and not serving.cancelled() and serving.exception():
+            raise serving.exception()
+
 async def main():
-    webserver = WebServer()
-    reminder = DutyReminder()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+        return
+    updates = WebhookUpdates() if WEBHOOK_URL else None
+    webserver = WebServer(webhook=updates)
+    cluster = Cluster(SqliteCoordinator(STATE_DB)) if WORKER_COUNT > 1 else None
     
     try:
+        await store.start()
         port = await webserver.start()
-        await reminder.start()
-        logger.info("Starting bot polling...")
-        await dp.start_polling(bot)
+        if updates:
+            await updates.start()
+        if cluster:
+            reminder.cluster = cluster
+            # Лимит Telegram общий на токен: делим его между воркерами
+            reminder.sender = FanOutSender(rate=SEND_RATE_LIMIT / WORKER_COUNT)
+            await cluster.start()
+            logger.info(f"Worker {WORKER_ID}/{WORKER_COUNT} started as node {cluster.node_id}")
+            await lead(cluster, updates, webserver, port)
+        else:
+            await store.load()
+            await reminder.start()
+            await receive_updates(updates, webserver, port)
     except asyncio.CancelledError:
         logger.info("Received shutdown signal")
     except Exception as e:
@@ -186,7 +1480,12 @@ async def main():
     finally:
         logger.info("Shutting down...")
         await reminder.stop()
+        if cluster:
+            await cluster.stop()
         await webserver.stop()
+        if updates:
+            await updates.stop()
+        await store.stop()
         await bot.session.close()
         logger.info("Shutdown complete")
 